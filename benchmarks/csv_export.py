@@ -0,0 +1,76 @@
+"""
+Compare the streaming CSV writer against the previous `DictWriter` + `io.StringIO` implementation.
+
+    python benchmarks/csv_export.py --places 100000
+"""
+
+import argparse
+import csv
+import io
+import tempfile
+import time
+from pathlib import Path
+
+from kmz_compression import make_map
+
+from shelter_map.common import Map, dump
+from shelter_map.convert import CSV_COLUMNS, _pairs_to_csv, write_csv
+
+
+def legacy_to_csv(map_: Map):
+    with io.StringIO() as fp:
+        writer = csv.DictWriter(fp, fieldnames=CSV_COLUMNS)
+        writer.writeheader()
+        for place in map_.places:
+            writer.writerow(
+                {
+                    "Name": place.name,
+                    "Latitude": place.lat,
+                    "Longitude": place.lon,
+                    "Description": _pairs_to_csv(place.desc),
+                }
+            )
+        return fp.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--places", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    map_ = make_map(args.places)
+    descriptions = [_pairs_to_csv(place.desc) for place in map_.places]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        legacy_path = Path(tmp_dir) / "legacy.csv"
+        path = Path(tmp_dir) / "streamed.csv"
+
+        def run_legacy():
+            dump(legacy_to_csv(map_), legacy_path)
+
+        def run_streamed():
+            with open(path, "wt", encoding="utf-8", newline="") as fp:
+                write_csv(map_, fp)
+
+        def run_streamed_precomputed():
+            with open(path, "wt", encoding="utf-8", newline="") as fp:
+                write_csv(map_, fp, descriptions=descriptions)
+
+        for label, run in [
+            ("DictWriter + StringIO", run_legacy),
+            ("write_csv", run_streamed),
+            ("write_csv (precomputed)", run_streamed_precomputed),
+        ]:
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                run()
+                timings.append(time.perf_counter() - start)
+            print(f"{label:>24}: {min(timings) * 1000:8.1f} ms")
+
+        assert legacy_path.read_bytes() == path.read_bytes()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Check that exports split into parts, from a whole map or streamed from an iterator, match a reference that slices
+the map into parts directly, and time both.
+
+    python benchmarks/export_parts.py --places 0 1500 3000 4000 4500 8001
+"""
+
+import argparse
+import contextlib
+import io
+import tempfile
+import time
+from pathlib import Path
+
+from kmz_compression import make_map
+
+from shelter_map.common import Map, dump
+from shelter_map.convert import FORMATS, dump_kmz, export, export_places, map_hash, to_csv, to_kml
+
+
+def reference_export(map_: Map, name: str, out_dir: Path, base_name: str, formats: list[str], max_per_file: int):
+    num_files = (len(map_.places) - 1) // max_per_file + 1
+    for file_idx in range(num_files):
+        suffix = "" if num_files == 1 else f".{file_idx + 1}"
+        name_of_part = name if num_files == 1 else f"{name} ({file_idx + 1})"
+        map_part = Map(icons=map_.icons, places=map_.places[file_idx * max_per_file : (file_idx + 1) * max_per_file])
+        for format in formats:
+            out_path = out_dir / f"{base_name}{suffix}.{format}"
+            if format == "csv":
+                dump(to_csv(map_=map_part), out_path)
+            else:
+                contents, attachments = to_kml(map_=map_part, embed_dataurl_icons=format == "kml", name=name_of_part)
+                if format == "kml":
+                    dump(contents, out_path)
+                else:
+                    dump_kmz(contents, out_path, attachments=attachments)
+    return map_hash(map_) * num_files
+
+
+def read_outputs(out_dir: Path) -> dict[str, bytes]:
+    return {path.name: path.read_bytes() for path in sorted(out_dir.iterdir())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--places", type=int, nargs="+", default=[0, 1500, 2000, 2001, 3000, 4000, 4500, 8001])
+    parser.add_argument("--max-per-file", type=int, default=2_000)
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=FORMATS)
+    args = parser.parse_args()
+
+    kwargs = dict(name="Shelters", base_name="shelters", formats=args.formats, max_per_file=args.max_per_file)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        reference_dir, whole_dir, streamed_dir = (Path(tmp_dir) / name for name in ("reference", "whole", "streamed"))
+        for out_dir in (reference_dir, whole_dir, streamed_dir):
+            out_dir.mkdir()
+
+        # Going up and back down through the sizes also exercises the removal of stale parts
+        for num_places in args.places + args.places[-2::-1]:
+            map_ = make_map(num_places)
+            for path in reference_dir.iterdir():
+                path.unlink()
+            with contextlib.redirect_stdout(io.StringIO()):
+                expected = reference_export(map_, out_dir=reference_dir, **kwargs)
+
+                start = time.perf_counter()
+                whole = export(map_, out_dir=whole_dir, **kwargs)
+                whole_seconds = time.perf_counter() - start
+
+                start = time.perf_counter()
+                streamed = export_places(
+                    map_.icons, places=(place for place in map_.places), out_dir=streamed_dir, **kwargs
+                )
+                streamed_seconds = time.perf_counter() - start
+
+            expected_outputs = read_outputs(reference_dir)
+            assert whole == expected, f"{num_places} places: hash of whole map export differs"
+            assert streamed == expected, f"{num_places} places: hash of streamed export differs"
+            assert read_outputs(whole_dir) == expected_outputs, f"{num_places} places: whole map outputs differ"
+            assert read_outputs(streamed_dir) == expected_outputs, f"{num_places} places: streamed outputs differ"
+            print(
+                f"{num_places:>8} places, {len(expected_outputs):>3} files:"
+                f" whole {whole_seconds * 1000:8.1f} ms, streamed {streamed_seconds * 1000:8.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
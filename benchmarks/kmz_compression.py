@@ -0,0 +1,72 @@
+"""
+Size vs. time of KMZ compression settings on a synthetic KML document.
+
+    python benchmarks/kmz_compression.py --places 20000
+"""
+
+import argparse
+import io
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+from shelter_map.common import Icon, Map, Place
+from shelter_map.convert import dump_kmz, to_kml
+
+
+def make_map(num_places: int) -> Map:
+    icon = Icon(label="מקלט", url="data:image/png;base64,iVBORw0KGgo=")
+    places = [
+        Place(
+            name=f"מקלט ציבורי רחוב הדוגמה {index}",
+            desc=(
+                ("זיהוי", str(index)),
+                ("כתובת", f"הדוגמה {index % 300}"),
+                ("שטח", f"{index % 90 + 10} מר"),
+            ),
+            icon=icon,
+            lon=34.75 + (index % 1000) * 1e-4,
+            lat=32.05 + (index // 1000) * 1e-4,
+        )
+        for index in range(num_places)
+    ]
+    return Map(icons=[icon], places=places)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--places", type=int, default=20_000)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 6, 9])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    contents, attachments = to_kml(make_map(args.places), embed_dataurl_icons=False)
+    print(f"doc.kml: {len(contents):,} bytes")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "bench.kmz"
+
+        start = time.perf_counter()
+        with zipfile.ZipFile(io.BytesIO(), "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("doc.kml", contents)
+        print(f"{'zipfile (baseline)':>24}: {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+        for level in args.levels:
+            for workers in args.workers:
+                timings = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    dump_kmz(contents, path, attachments, compresslevel=level, workers=workers)
+                    timings.append(time.perf_counter() - start)
+                with zipfile.ZipFile(path) as archive:
+                    assert archive.read("doc.kml") == contents
+                print(
+                    f"{f'level={level} workers={workers}':>24}: {min(timings) * 1000:8.1f} ms, "
+                    f"{path.stat().st_size:>12,} bytes"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Startup cost of the CLIs: wall time of importing their entry modules in a fresh interpreter, and which heavy
+dependencies got imported along the way.
+
+    python benchmarks/startup.py
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+MODULES = ["shelter_map.convert", "shelter_map.download"]
+HEAVY_MODULES = ["requests", "xml.dom.minidom", "zipfile", "concurrent.futures", "platform", "cProfile", "tracemalloc"]
+PROBE = "import sys, {module}; print(' '.join(m for m in {heavy!r} if m in sys.modules))"
+
+
+def run(code: str) -> tuple[float, str]:
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    return time.perf_counter() - start, output.strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    baseline = min(run("pass")[0] for _ in range(args.repeat))
+    print(f"{'python -c pass':>24}: {baseline * 1000:8.1f} ms")
+    for module in MODULES:
+        code = PROBE.format(module=module, heavy=HEAVY_MODULES)
+        timings, loaded = zip(*(run(code) for _ in range(args.repeat)))
+        print(
+            f"{f'import {module}':>24}: {min(timings) * 1000:8.1f} ms "
+            f"(+{(min(timings) - baseline) * 1000:.1f} ms), heavy modules: {loaded[0] or 'none'}"
+        )
+    print(f"For a per-module breakdown run: {sys.executable} -X importtime -c 'import {MODULES[0]}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,19 @@
+import importlib
+
 from ..common import City
-from . import jerusalem, tel_aviv
 
-all_cities: list[City] = [tel_aviv, jerusalem]
+# Module names under this package. Cities are only imported once selected, see `load_city`.
+CITY_KEYS = ["tel_aviv", "jerusalem"]
+
+
+def load_city(key: str) -> City:
+    if key not in CITY_KEYS:
+        raise ValueError(f"Unknown city: {key!r}")
+    return importlib.import_module(f"{__name__}.{key}")
+
+
+def __getattr__(name: str):
+    # `all_cities` used to be a module-level list; keep it available without importing every city up front
+    if name == "all_cities":
+        return [load_city(key) for key in CITY_KEYS]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,26 +1,39 @@
 import csv
+import heapq
 import json
 import logging
 import re
-from collections import defaultdict
+import threading
+import time
+import typing
+from collections import Counter, defaultdict
+from contextlib import closing, suppress
 from pathlib import Path
-
-import requests
+from queue import Empty, Full, Queue
 
 from ..common import (
     Icon,
     JsonValue,
     Map,
     Place,
+    atomic_open,
+    batch_size_for_memory_budget,
     cached_image_url_to_dataurl,
     dump,
     format_sqm,
     get_fair_user_agent,
     get_update_date,
     identity,
+    iter_batches,
+    iter_json_array,
     load,
     map_pairs,
 )
+from ..coords import Polygon, fix_coordinates, report_coordinates
+from ..metrics import count, span
+
+if typing.TYPE_CHECKING:
+    import requests
 
 logger = logging.getLogger(__name__)
 
@@ -93,10 +106,13 @@ DESCRIPTION_MAPPING = {
     Cols.SOURCE: True,
     Cols.RECORD_DATE: True,
 }
+DIFF_IGNORED_LABELS = frozenset({Cols.RECORD_DATE})
+# Rough (lon, lat) outline of Jerusalem, with some margin
+BOUNDS: Polygon = [(35.07, 31.68), (35.30, 31.68), (35.30, 31.90), (35.07, 31.90)]
 
 
 def geocode_addresses_batch(
-    session: requests.Session,
+    session: "requests.Session",
     addrs: list[str],
     *,
     chunk_size: int = 200,
@@ -144,6 +160,8 @@ def geocode_addresses_batch(
             timeout=timeout,
         )
         r.raise_for_status()
+        count("http_requests")
+        count("http_bytes_in", len(r.content))
         data = r.json()
 
         for locations in data.get("locations", []):
@@ -229,51 +247,87 @@ def fix_item_during_generate(item: dict):
     return item
 
 
-def generate_map(data_dir: Path, icons_as_dataurls: bool = True):
-    json_path = data_dir / JSON_NAME
-    logger.debug("Reading: %s", json_path)
-
-    data = load(json_path)
-    update_date = get_update_date(json_path)
-    logger.debug("Loaded. Update date: %s", update_date)
-
-    places = []
-
+def get_icon(icons_as_dataurls: bool = True) -> Icon:
     # TODO : It'd be nice to have distinct icons per shelter type,
     #        but the GIS service doesn't provide additional icons,
     #        and the "סוג" column almost never contains the actual type.
     icon_url = ICON_URL
     if icons_as_dataurls:
         icon_url = cached_image_url_to_dataurl(icon_url)
-    icon = Icon(label="מקלט", url=icon_url)
-    icons = [icon]
+    return Icon(label="מקלט", url=icon_url)
+
+
+def iter_places(
+    data: typing.Iterable[dict],
+    icon: Icon,
+    update_date: str,
+    batch_size: int | None = None,
+) -> typing.Iterator[Place]:
+    statuses = Counter()
+    for batch in iter_batches(data, batch_size):
+        items = [
+            dict(fix_item_during_generate(item), **{Cols.SOURCE: SOURCE_URL, Cols.RECORD_DATE: update_date})
+            for item in batch
+        ]
+        # Despite the column names, values are not guaranteed to be (lon, lat); the coordinate stage sorts that out
+        coordinates, batch_statuses = fix_coordinates(
+            [(item[Cols.LON], item[Cols.LAT]) for item in items],
+            bounds=BOUNDS,
+        )
+        statuses.update(batch_statuses)
 
-    for item in data:
-        item = fix_item_during_generate(item)
-        item = dict(item, **{Cols.SOURCE: SOURCE_URL, Cols.RECORD_DATE: update_date})
-        name = item[Cols.ADDR1]
-        shelter_type = item[Cols.TYPE]
-        if shelter_type:
-            name = f"{shelter_type} {name}"
+        for item, point in zip(items, coordinates):
+            name = item[Cols.ADDR1]
+            shelter_type = item[Cols.TYPE]
+            if shelter_type:
+                name = f"{shelter_type} {name}"
 
-        lon_str = item[Cols.LON]
-        lat_str = item[Cols.LAT]
+            if point is None:
+                logger.warning(f"Missing or invalid coordinates for {name!r}. Skipping.")
+                continue
 
-        if not lon_str or not lat_str:
-            logger.warning(f"Missing coordinates for {name!r}. Skipping.")
-            continue
+            lon, lat = point
+
+            desc = map_pairs(item, mapping=DESCRIPTION_MAPPING)
+            yield Place(name=name, desc=desc, icon=icon, lon=lon, lat=lat, key=item[Cols.ID])
+    report_coordinates(NAME, statuses)
 
-        lon = float(lon_str)
-        lat = float(lat_str)
 
-        desc = map_pairs(item, mapping=DESCRIPTION_MAPPING)
-        places.append(Place(name=name, desc=desc, icon=icon, lon=lon, lat=lat))
+def generate_map(data_dir: Path, icons_as_dataurls: bool = True):
+    json_path = data_dir / JSON_NAME
+    logger.debug("Reading: %s", json_path)
+
+    data = load(json_path)
+    update_date = get_update_date(json_path)
+    logger.debug("Loaded. Update date: %s", update_date)
+
+    icon = get_icon(icons_as_dataurls=icons_as_dataurls)
+    icons = [icon]
+
+    places = list(iter_places(data, icon=icon, update_date=update_date))
 
     logger.debug("Number of entries: %s, unique places: %s, icons: %s", len(data), len(places), len(icons))
 
     return Map(icons=icons, places=places)
 
 
+def iter_map(
+    data_dir: Path,
+    batch_size: int,
+    icons_as_dataurls: bool = True,
+) -> tuple[list[Icon], typing.Iterator[Place]]:
+    """
+    Like `generate_map`, but streams the records from disk and yields places `batch_size` records at a time
+    """
+    json_path = data_dir / JSON_NAME
+    logger.debug("Streaming: %s", json_path)
+
+    update_date = get_update_date(json_path)
+    icon = get_icon(icons_as_dataurls=icons_as_dataurls)
+    places = iter_places(iter_json_array(json_path), icon=icon, update_date=update_date, batch_size=batch_size)
+    return [icon], places
+
+
 def fix_item_during_download(item: dict[str, JsonValue]):
     addr1 = item[Cols.ADDR1] = normalize_addr(item[Cols.ADDR1], item)
     addr2 = item[Cols.ADDR2] = normalize_addr(item[Cols.ADDR2], item)
@@ -283,11 +337,24 @@ def fix_item_during_download(item: dict[str, JsonValue]):
     return item
 
 
-def download_data(data_dir: Path, node_id: int = 139154, skip_geocodes: bool = False):
+def make_session() -> "requests.Session":
+    import requests
+
     session = requests.Session()
     user_agent = get_fair_user_agent()
     session.headers.update({"user-agent": user_agent})
     logger.debug("Session headers: %s", session.headers)
+    return session
+
+
+def download_data(
+    data_dir: Path,
+    node_id: int = 139154,
+    skip_geocodes: bool = False,
+    pipelined: bool = False,
+    memory_budget: int | None = None,
+):
+    session = make_session()
 
     params = {"nodeId": str(node_id), "culture": "he-IL", "searchMs": "true"}
     headers = {
@@ -302,14 +369,32 @@ def download_data(data_dir: Path, node_id: int = 139154, skip_geocodes: bool = F
         "Downloading: %s",
         kwargs,
     )
-    response = session.get(**kwargs)
-    response.raise_for_status()
+    if memory_budget is not None:
+        # The pipelined mode keeps records waiting for geocodes in memory, so the memory-bounded mode takes precedence
+        download_data_out_of_core(
+            session,
+            kwargs,
+            out_path=data_dir / JSON_NAME,
+            skip_geocodes=skip_geocodes,
+            batch_size=batch_size_for_memory_budget(memory_budget),
+        )
+        return
+    if pipelined:
+        download_data_pipelined(session, kwargs, out_path=data_dir / JSON_NAME, skip_geocodes=skip_geocodes)
+        return
+
+    with span("export_csv"):
+        response = session.get(**kwargs)
+        response.raise_for_status()
+    count("http_requests")
+    count("http_bytes_in", len(response.content))
 
     # strip byte-order mark if it exists
     contents = response.content.decode("utf-8")
     contents = contents.lstrip("\ufeff").splitlines()
     reader = csv.DictReader(contents)
     items = [fix_item_during_download(item) for item in reader]
+    count("records", len(items))
 
     missing_lonlat_addr_to_items: dict[str, list[dict[str, JsonValue]]] = defaultdict(list)
 
@@ -323,7 +408,9 @@ def download_data(data_dir: Path, node_id: int = 139154, skip_geocodes: bool = F
 
     if not skip_geocodes:
         logger.debug("Geocoding %s addresses with missing coordinates...", len(missing_lonlat_addr_to_items))
-        geocodes = geocode_addresses_batch(session, sorted(missing_lonlat_addr_to_items))
+        with span("geocode"):
+            geocodes = geocode_addresses_batch(session, sorted(missing_lonlat_addr_to_items))
+        count("geocoded_addresses", sum(lon is not None for lon, _ in geocodes.values()))
         for addr, (lon, lat) in geocodes.items():
             for item in missing_lonlat_addr_to_items[addr]:
                 # only update missing fields
@@ -332,3 +419,290 @@ def download_data(data_dir: Path, node_id: int = 139154, skip_geocodes: bool = F
 
     out_path = data_dir / JSON_NAME
     dump(json.dumps(items, indent=1, ensure_ascii=False), out_path)
+
+
+_DONE = object()
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+def _put(queue: Queue, value, stop: threading.Event):
+    # A bounded put that gives up once another stage has failed, so no thread is left blocked on a full queue
+    while not stop.is_set():
+        try:
+            queue.put(value, timeout=0.1)
+            return
+        except Full:
+            continue
+    raise PipelineStopped()
+
+
+def _get(queue: Queue, stop: threading.Event, timeout: float | None = None):
+    # Like `_put`; raises `Empty` if nothing arrives within `timeout` seconds, if given
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while not stop.is_set():
+        wait = 0.1 if deadline is None else min(0.1, deadline - time.monotonic())
+        if wait <= 0:
+            raise Empty()
+        try:
+            return queue.get(timeout=wait)
+        except Empty:
+            continue
+    raise PipelineStopped()
+
+
+def _pipeline_stage(stage):
+    """
+    Stop the whole pipeline if `stage` fails, and signal the next stage once it's done either way
+    """
+
+    def run(*args, out: Queue, stop: threading.Event):
+        try:
+            stage(*args, out=out, stop=stop)
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            with suppress(PipelineStopped):
+                _put(out, _DONE, stop)
+
+    return run
+
+
+def iter_export_lines(response: "requests.Response") -> typing.Iterator[str]:
+    """
+    Decoded lines of a streamed CSV export response
+    """
+    first = True
+    for line in response.iter_lines():
+        count("http_bytes_in", len(line) + 1)
+        line = line.decode("utf-8")
+        if first:
+            # strip byte-order mark if it exists
+            line = line.lstrip("\ufeff")
+            first = False
+        yield line
+
+
+def write_items_json(fp: typing.TextIO, items: typing.Iterable[dict[str, JsonValue]]):
+    """
+    Write `items` one at a time, in the same layout as `json.dumps(items, indent=1)`
+    """
+    empty = True
+    for item in items:
+        fp.write("[\n " if empty else ",\n ")
+        fp.write(json.dumps(item, indent=1, ensure_ascii=False).replace("\n", "\n "))
+        empty = False
+    fp.write("[]" if empty else "\n]")
+
+
+@_pipeline_stage
+def _read_items(session: "requests.Session", kwargs: dict, *, out: Queue, stop: threading.Event):
+    with session.get(**kwargs, stream=True) as response:
+        response.raise_for_status()
+        count("http_requests")
+        for index, item in enumerate(csv.DictReader(iter_export_lines(response))):
+            _put(out, (index, fix_item_during_download(item)), stop)
+            count("records")
+
+
+@_pipeline_stage
+def _geocode_items(
+    session: "requests.Session",
+    items: Queue,
+    skip_geocodes: bool,
+    chunk_size: int,
+    flush_after: float,
+    max_reorder: int,
+    *,
+    out: Queue,
+    stop: threading.Event,
+):
+    # address -> items waiting for it, in the batch currently being collected
+    pending: dict[str, list[tuple[int, dict[str, JsonValue]]]] = defaultdict(list)
+    geocodes: dict[str, tuple[float | None, float | None]] = {}
+    # index and arrival time of the oldest item in `pending`
+    oldest_index, oldest_time = 0, 0.0
+
+    def resolve(addr: str, index: int, item: dict[str, JsonValue]):
+        lon, lat = geocodes[addr]
+        # only update missing fields
+        item[Cols.LON] = item[Cols.LON] or lon
+        item[Cols.LAT] = item[Cols.LAT] or lat
+        _put(out, (index, item), stop)
+
+    def flush():
+        if not pending:
+            return
+        logger.debug("Geocoding %s addresses with missing coordinates...", len(pending))
+        batch_geocodes = geocode_addresses_batch(session, sorted(pending), chunk_size=chunk_size)
+        count("geocoded_addresses", sum(lon is not None for lon, _ in batch_geocodes.values()))
+        geocodes.update(batch_geocodes)
+        for addr, waiting in pending.items():
+            for index, item in waiting:
+                resolve(addr, index, item)
+        pending.clear()
+
+    while True:
+        try:
+            # Don't hold a partial batch for long: the writer can't get past its oldest item until it's geocoded
+            value = _get(items, stop, timeout=oldest_time + flush_after - time.monotonic() if pending else None)
+        except Empty:
+            flush()
+            continue
+        if value is _DONE:
+            break
+        index, item = value
+        addr = item[Cols.ADDR1]
+        if skip_geocodes or (item[Cols.LON] and item[Cols.LAT]):
+            _put(out, (index, item), stop)
+        elif addr in geocodes:
+            resolve(addr, index, item)
+        else:
+            if not pending:
+                oldest_index, oldest_time = index, time.monotonic()
+            pending[addr].append((index, item))
+            if len(pending) >= chunk_size:
+                flush()
+        # Every item after the oldest pending one waits in the writer's reorder buffer, so flush before it grows
+        # past `max_reorder`
+        if pending and index - oldest_index >= max_reorder:
+            flush()
+    flush()
+
+
+def download_data_pipelined(
+    session: "requests.Session",
+    kwargs: dict,
+    out_path: Path,
+    skip_geocodes: bool = False,
+    chunk_size: int = 200,
+    queue_size: int = 1_000,
+    flush_after: float = 0.5,
+    max_reorder: int = 1_000,
+):
+    """
+    Stream the CSV export, geocode and write records concurrently.
+
+    A reader thread parses the export while it downloads, a geocoder thread sends addresses with missing coordinates
+    once a batch of `chunk_size` fills up or its oldest address has waited `flush_after` seconds, and this thread
+    writes records out as they are resolved. Stages are connected by bounded queues. Records are written in their
+    original order, in the same layout as the sequential mode; at most about `max_reorder` of them wait for an
+    earlier one to be geocoded.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    items: Queue = Queue(maxsize=queue_size)
+    resolved: Queue = Queue(maxsize=queue_size)
+    stop = threading.Event()
+    # requests sessions aren't guaranteed to be thread-safe, so the geocoder gets its own
+    geocode_session = make_session()
+
+    with span("pipeline"), ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(_read_items, session, kwargs, out=items, stop=stop),
+            executor.submit(
+                _geocode_items,
+                geocode_session,
+                items,
+                skip_geocodes,
+                chunk_size,
+                flush_after,
+                max_reorder,
+                out=resolved,
+                stop=stop,
+            ),
+        ]
+        try:
+            # Records leave the geocoder out of order; each is written once all the earlier ones have been
+            reorder: list[tuple[int, dict]] = []
+
+            def iter_in_order():
+                next_index = 0
+                while (value := _get(resolved, stop)) is not _DONE:
+                    heapq.heappush(reorder, value)
+                    while reorder and reorder[0][0] == next_index:
+                        yield heapq.heappop(reorder)[1]
+                        next_index += 1
+                if reorder:
+                    raise RuntimeError(f"Pipeline lost records: {len(reorder)} could not be written in order")
+
+            with atomic_open(out_path, "wt", encoding="utf-8") as fp:
+                write_items_json(fp, iter_in_order())
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            # Prefer the error of the stage that failed over those of the stages it stopped
+            for future in futures:
+                error = future.exception()
+                if error is not None and not isinstance(error, PipelineStopped):
+                    raise error
+
+
+def download_data_out_of_core(
+    session: "requests.Session",
+    kwargs: dict,
+    out_path: Path,
+    skip_geocodes: bool = False,
+    batch_size: int = 1_000,
+):
+    """
+    Download with memory bounded by `batch_size` records, spilling records and geocodes to a temporary SQLite file.
+
+    The export is streamed into the spill file, the distinct addresses missing coordinates are geocoded a batch at a
+    time (in sorted order, as in the sequential mode), and the output is written by streaming the records back in
+    their original order joined with their geocodes.
+    """
+    # imported here, as only this mode needs them
+    import sqlite3
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir, closing(sqlite3.connect(Path(tmp_dir) / "spill.sqlite")) as db:
+        db.execute("CREATE TABLE records (idx INTEGER PRIMARY KEY, addr TEXT, missing INTEGER, item TEXT)")
+        db.execute("CREATE TABLE geocodes (addr TEXT PRIMARY KEY, lon REAL, lat REAL)")
+
+        with span("export_csv"), session.get(**kwargs, stream=True) as response:
+            response.raise_for_status()
+            count("http_requests")
+            rows = enumerate(fix_item_during_download(item) for item in csv.DictReader(iter_export_lines(response)))
+            for batch in iter_batches(rows, batch_size):
+                db.executemany(
+                    "INSERT INTO records VALUES (?, ?, ?, ?)",
+                    [
+                        (index, item[Cols.ADDR1], not (item[Cols.LON] and item[Cols.LAT]), json.dumps(item))
+                        for index, item in batch
+                    ],
+                )
+                count("records", len(batch))
+
+        if not skip_geocodes:
+            with span("geocode"):
+                addrs = db.execute("SELECT DISTINCT addr FROM records WHERE missing ORDER BY addr")
+                while batch := [addr for (addr,) in addrs.fetchmany(batch_size)]:
+                    logger.debug("Geocoding %s addresses with missing coordinates...", len(batch))
+                    geocodes = geocode_addresses_batch(session, batch)
+                    count("geocoded_addresses", sum(lon is not None for lon, _ in geocodes.values()))
+                    db.executemany(
+                        "INSERT INTO geocodes VALUES (?, ?, ?)",
+                        [(addr, lon, lat) for addr, (lon, lat) in geocodes.items()],
+                    )
+
+        def iter_items():
+            rows = db.execute(
+                "SELECT r.item, g.addr IS NOT NULL, g.lon, g.lat FROM records r"
+                " LEFT JOIN geocodes g ON r.missing AND g.addr = r.addr ORDER BY r.idx"
+            )
+            while batch := rows.fetchmany(batch_size):
+                for item_json, geocoded, lon, lat in batch:
+                    item = json.loads(item_json)
+                    if geocoded:
+                        # only update missing fields
+                        item[Cols.LON] = item[Cols.LON] or lon
+                        item[Cols.LAT] = item[Cols.LAT] or lat
+                    yield item
+
+        with atomic_open(out_path, "wt", encoding="utf-8") as fp:
+            write_items_json(fp, iter_items())
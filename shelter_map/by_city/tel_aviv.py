@@ -1,9 +1,26 @@
 import logging
+import typing
+from collections import Counter
 from pathlib import Path
 
-import requests
-
-from ..common import FieldMapping, Icon, Map, Place, dump, format_sqm, get_update_date, identity, load, map_pairs
+from ..common import (
+    FieldMapping,
+    Icon,
+    Map,
+    Place,
+    atomic_open,
+    dump,
+    format_sqm,
+    get_update_date,
+    identity,
+    iter_batches,
+    iter_json_array,
+    load,
+    map_pairs,
+    read_json_head,
+)
+from ..coords import Polygon, fix_coordinates, report_coordinates
+from ..metrics import count
 
 logger = logging.getLogger(__name__)
 
@@ -24,9 +41,17 @@ DESCRIPTION_MAPPING: FieldMapping = {
     "date_import": True,
     "__source": ("מקור המידע", identity),
 }
+DIFF_IGNORED_LABELS = frozenset()
+# Rough (lon, lat) outline of Tel Aviv-Yafo, with some margin
+BOUNDS: Polygon = [(34.73, 32.02), (34.86, 32.02), (34.86, 32.15), (34.73, 32.15)]
+
 
+def get_tel_aviv_json(layer: str, limit: int, out_path: Path | None = None):
+    """
+    Download the layer's features; with `out_path`, stream them into that file instead of returning them
+    """
+    import requests
 
-def get_tel_aviv_json(layer: str, limit: int):
     url = f"{BASE_URL}/{layer}/query"
 
     params = {
@@ -41,12 +66,26 @@ def get_tel_aviv_json(layer: str, limit: int):
     }
 
     logger.debug("Downloading data: %s", dict(url=url, params=params))
+    if out_path is not None:
+        with requests.get(url, params=params, stream=True) as response:
+            response.raise_for_status()
+            count("http_requests")
+            with atomic_open(out_path, "wb") as fp:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    count("http_bytes_in", len(chunk))
+                    fp.write(chunk)
+        return
+
     response = requests.get(url, params=params)
     response.raise_for_status()
+    count("http_requests")
+    count("http_bytes_in", len(response.content))
     return response.content
 
 
 def get_tel_aviv_meta_json(layer: str):
+    import requests
+
     url = f"{BASE_URL}/{layer}"
     params = {
         "f": "pjson",
@@ -55,6 +94,8 @@ def get_tel_aviv_meta_json(layer: str):
     logger.debug("Downloading metadata: %s", dict(url=url, params=params))
     response = requests.get(url, params=params)
     response.raise_for_status()
+    count("http_requests")
+    count("http_bytes_in", len(response.content))
     return response.content
 
 
@@ -83,6 +124,34 @@ def get_icon_map(meta_data: dict):
     }
 
 
+def iter_places(
+    features: typing.Iterable[dict],
+    aliases: dict[str, str],
+    icon_map: dict[str | None, Icon],
+    batch_size: int | None = None,
+) -> typing.Iterator[Place]:
+    statuses = Counter()
+    for batch in iter_batches(features, batch_size):
+        all_attrs = [dict(feature["attributes"], __source=SOURCE_URL) for feature in batch]
+        coordinates, batch_statuses = fix_coordinates(
+            [(attrs.get("lon"), attrs.get("lat")) for attrs in all_attrs],
+            bounds=BOUNDS,
+        )
+        statuses.update(batch_statuses)
+
+        for attrs, point in zip(all_attrs, coordinates):
+            # Skip if no usable coordinates
+            if point is None:
+                continue
+
+            name = build_name(attrs)
+            desc = map_pairs(attrs, mapping=DESCRIPTION_MAPPING, labels=aliases)
+            icon = icon_map.get(attrs.get("t_sug"), icon_map[None])
+            lon, lat = point
+            yield Place(name=name, desc=desc, icon=icon, lon=lon, lat=lat, key=attrs.get("ms_miklat"))
+    report_coordinates(NAME, statuses)
+
+
 def generate_map(data_dir: Path):
     data_path = data_dir / SHELTERS_JSON
     meta_data_path = data_dir / SHELTERS_META_JSON
@@ -98,20 +167,7 @@ def generate_map(data_dir: Path):
 
     icon_map = get_icon_map(meta_data=meta_data)
 
-    places = []
-    for feature in data["features"]:
-        attrs = dict(feature["attributes"], __source=SOURCE_URL)
-
-        # Skip if no coordinates
-        if not attrs.get("lat") or not attrs.get("lon"):
-            continue
-
-        name = build_name(attrs)
-        desc = map_pairs(attrs, mapping=DESCRIPTION_MAPPING, labels=aliases)
-        icon = icon_map.get(attrs.get("t_sug"), icon_map[None])
-        lon = float(attrs["lon"])
-        lat = float(attrs["lat"])
-        places.append(Place(name=name, desc=desc, icon=icon, lon=lon, lat=lat))
+    places = list(iter_places(data["features"], aliases=aliases, icon_map=icon_map))
 
     icons = list(icon_map.values())
 
@@ -119,8 +175,48 @@ def generate_map(data_dir: Path):
     return Map(icons=icons, places=places)
 
 
-def download_data(data_dir: Path, layer: str = "592", limit: int = 5_000):
+def iter_map(data_dir: Path, batch_size: int) -> tuple[list[Icon], typing.Iterator[Place]]:
+    """
+    Like `generate_map`, but streams the features from disk and yields places `batch_size` features at a time
+    """
+    data_path = data_dir / SHELTERS_JSON
+    meta_data_path = data_dir / SHELTERS_META_JSON
+    logger.debug("Streaming: data=%s, meta_data=%s", data_path, meta_data_path)
+
+    aliases = read_json_head(data_path, keys={"fieldAliases"})["fieldAliases"]
+    icon_map = get_icon_map(meta_data=load(meta_data_path))
+    places = iter_places(
+        iter_json_array(data_path, key="features"),
+        aliases=aliases,
+        icon_map=icon_map,
+        batch_size=batch_size,
+    )
+    return list(icon_map.values()), places
+
+
+def download_data(
+    data_dir: Path,
+    layer: str = "592",
+    limit: int = 5_000,
+    pipelined: bool = False,
+    memory_budget: int | None = None,
+):
     out_path = data_dir / SHELTERS_JSON
     meta_out_path = data_dir / SHELTERS_META_JSON
+    if memory_budget is not None:
+        # Features go straight to disk rather than through memory; the metadata is small
+        get_tel_aviv_json(layer=layer, limit=limit, out_path=out_path)
+        dump(get_tel_aviv_meta_json(layer=layer), meta_out_path)
+        return
+    if pipelined:
+        # The two requests are independent, so overlap them
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            data = executor.submit(get_tel_aviv_json, layer=layer, limit=limit)
+            meta_data = executor.submit(get_tel_aviv_meta_json, layer=layer)
+            dump(data.result(), out_path)
+            dump(meta_data.result(), meta_out_path)
+        return
     dump(get_tel_aviv_json(layer=layer, limit=limit), out_path)
     dump(get_tel_aviv_meta_json(layer=layer), meta_out_path)
@@ -1,16 +1,18 @@
 import base64
 import json
-import platform
+import os
 import sys
+import threading
 import typing
+from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from functools import cache
+from itertools import islice
 from pathlib import Path
 
-import requests
-
 from . import __version__
+from .metrics import count
 
 
 @dataclass(frozen=True)
@@ -26,6 +28,8 @@ class Place:
     icon: Icon
     lon: float
     lat: float
+    # stable identifier of the place in the source dataset, used to diff successive snapshots
+    key: str | None = None
 
 
 @dataclass
@@ -36,9 +40,12 @@ class Map:
 
 class City(typing.Protocol):
     NAME: str
+    # description labels left out when comparing snapshots, e.g. ones that change on every download
+    DIFF_IGNORED_LABELS: frozenset[str]
 
     def generate_map(self, data_dir: Path) -> Map: ...
-    def download_data(self, data_dir: Path): ...
+    def iter_map(self, data_dir: Path, batch_size: int) -> tuple[list[Icon], typing.Iterator[Place]]: ...
+    def download_data(self, data_dir: Path, pipelined: bool = False, memory_budget: int | None = None): ...
 
 
 JsonValue = dict["JsonValue"] | list["JsonValue"] | int | bool | str | None
@@ -47,6 +54,10 @@ FieldMapping = dict[str, typing.Literal[True] | tuple[str, typing.Callable[[Json
 
 @cache
 def get_fair_user_agent() -> str:
+    import platform
+
+    import requests
+
     return (
         f"Python/{sys.version_info.major}.{sys.version_info.minor} "
         f"({platform.system()}) shelter_map/{__version__} requests/{requests.__version__}"
@@ -54,15 +65,25 @@ def get_fair_user_agent() -> str:
 
 
 def image_url_to_dataurl(url: str):
+    import requests
+
     response = requests.get(url, headers={"user-agent": get_fair_user_agent()})
     response.raise_for_status()
+    count("http_requests")
+    count("http_bytes_in", len(response.content))
     content_type = response.headers["content-type"]
     return f"data:{content_type};base64,{base64.b64encode(response.content).decode()}"
 
 
-@cache
+_dataurl_cache: dict[str, str] = {}
+
+
 def cached_image_url_to_dataurl(url: str):
-    return image_url_to_dataurl(url)
+    if url in _dataurl_cache:
+        count("icon_cache_hits")
+    else:
+        _dataurl_cache[url] = image_url_to_dataurl(url)
+    return _dataurl_cache[url]
 
 
 def load(path: str | Path):
@@ -79,6 +100,157 @@ def load(path: str | Path):
     raise NotImplementedError("Only .json and .csv file readers are implemented")
 
 
+# Rough upper bound of the memory a single record takes while in flight: the raw item, its `Place` and its rendered
+# description and markup
+RECORD_MEMORY_ESTIMATE = 16 * 1024
+
+
+def batch_size_for_memory_budget(memory_budget: int) -> int:
+    """
+    Number of records to process at once within `memory_budget` megabytes, leaving most of it to the interpreter,
+    the rendered output parts and the OS buffers
+    """
+    return max(100, memory_budget * 1024 * 1024 // 4 // RECORD_MEMORY_ESTIMATE)
+
+
+def iter_batches(iterable: typing.Iterable, size: int | None) -> typing.Iterator[list]:
+    """
+    Split `iterable` into lists of `size` items; `None` means a single batch of everything
+    """
+    if size is None:
+        yield list(iterable)
+        return
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+JSON_CHUNK_SIZE = 1 << 16
+# What may follow a complete JSON value
+_JSON_DELIMITERS = frozenset(",]}:")
+_json_decoder = json.JSONDecoder()
+
+
+class _JsonStream:
+    """
+    Incremental tokenizer over a JSON file, reading it in chunks so only one value at a time is held in memory
+    """
+
+    def __init__(self, fp: typing.TextIO):
+        self.fp = fp
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.fp.read(JSON_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON")
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} at {self.pos}, got {self.buffer[self.pos]!r}")
+        self.pos += 1
+
+    def value(self) -> JsonValue:
+        self.peek()
+        while True:
+            try:
+                value, end = _json_decoder.raw_decode(self.buffer, self.pos)
+                # A number cut by the end of the buffer (e.g. "32." of "32.08") may continue in the next chunk, so
+                # only accept a value once what follows it is in the buffer and ends it
+                if self.eof or (
+                    end < len(self.buffer) and (self.buffer[end].isspace() or self.buffer[end] in _JSON_DELIMITERS)
+                ):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def skip(self):
+        # Arrays are streamed through, so skipping a large one doesn't load it
+        if self.peek() == "[":
+            for _ in self.iter_array():
+                pass
+        else:
+            self.value()
+
+    def iter_array(self) -> typing.Iterator[JsonValue]:
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == "]":
+                self.pos += 1
+                return
+            self.expect(",")
+
+
+def iter_json_array(path: str | Path, key: str | None = None) -> typing.Iterator[JsonValue]:
+    """
+    Stream the elements of the top-level JSON array in `path`, or of the array under the top-level `key`, without
+    loading the whole file. Other top-level values are skipped.
+    """
+    with open(path, "r", encoding="utf-8") as fp:
+        stream = _JsonStream(fp)
+        if key is None:
+            yield from stream.iter_array()
+            return
+        stream.expect("{")
+        while stream.peek() != "}":
+            name = stream.value()
+            stream.expect(":")
+            if name == key:
+                yield from stream.iter_array()
+                return
+            stream.skip()
+            if stream.peek() == ",":
+                stream.pos += 1
+        raise KeyError(key)
+
+
+def read_json_head(path: str | Path, keys: typing.Collection[str]) -> dict[str, JsonValue]:
+    """
+    Read the members `keys` of the top-level JSON object in `path`, stopping as soon as all of them have been read.
+
+    Cheap when they come before the bulk of the file (e.g. ArcGIS's "fieldAliases" before "features"); other members
+    on the way are skipped without being kept. Keys that aren't in the file are left out.
+    """
+    head = {}
+    with open(path, "r", encoding="utf-8") as fp:
+        stream = _JsonStream(fp)
+        stream.expect("{")
+        while len(head) < len(keys) and stream.peek() != "}":
+            name = stream.value()
+            stream.expect(":")
+            if name in keys:
+                head[name] = stream.value()
+            else:
+                stream.skip()
+            if stream.peek() == ",":
+                stream.pos += 1
+    return head
+
+
 def get_city_name(city: City):
     return getattr(city, "NAME", get_city_key(city))
 
@@ -113,11 +285,43 @@ def map_pairs(item: dict, mapping: FieldMapping, labels: dict = None):
     return pairs
 
 
+def fsync_dir(path: str | Path):
+    # Makes renames within the directory durable; not supported (nor needed) on Windows
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_open(path: str | Path, mode: str = "wb", encoding: str | None = None, newline: str | None = None):
+    """
+    Open a temporary file next to `path` for writing, and move it onto `path` once it has been written and synced,
+    so readers never see a partially written file.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, mode, encoding=encoding, newline=newline) as fp:
+            yield fp
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    fsync_dir(path.parent)
+
+
 def dump(data: bytes | str, path: str | Path):
-    Path(path).parent.mkdir(parents=True, exist_ok=True)
     is_bytes = isinstance(data, bytes)
-    with open(path, "wb" if is_bytes else "wt", encoding=None if is_bytes else "utf-8") as fp:
+    with atomic_open(path, "wb" if is_bytes else "wt", encoding=None if is_bytes else "utf-8") as fp:
         fp.write(data)
+    count("bytes_out", len(data) if is_bytes else len(data.encode("utf-8")))
 
 
 def get_update_date(path: Path) -> str:
@@ -6,44 +6,54 @@ import hashlib
 import io
 import json
 import logging
-import zipfile
+import re
+import typing
+from collections import deque
+from contextlib import nullcontext
+from itertools import chain, islice
 from pathlib import Path
-from xml.dom.minidom import Document
 
-from .by_city import all_cities
-from .common import Map, dump
+from . import kmz, metrics
+from .by_city import CITY_KEYS, load_city
+from .common import Icon, Map, Place, atomic_open, batch_size_for_memory_budget, dump, iter_batches
+from .metrics import count, span
+from .publish import link_from_current, publish
 
 
 logger = logging.getLogger(__name__)
 
 
-def to_csv(map_: Map):
-    """
-    Produce CSV format for Google Maps import
-    """
-    # Define the essential columns for Google Maps
-    csv_columns = [
-        "Name",  # Location name
-        "Latitude",  # Latitude coordinate
-        "Longitude",  # Longitude coordinate
-        "Description",  # Description/notes
-    ]
+# Define the essential columns for Google Maps
+CSV_COLUMNS = [
+    "Name",  # Location name
+    "Latitude",  # Latitude coordinate
+    "Longitude",  # Longitude coordinate
+    "Description",  # Description/notes
+]
+
 
-    with io.StringIO() as fp:
-        writer = csv.DictWriter(fp, fieldnames=csv_columns)
-        writer.writeheader()
+def write_csv(map_: Map, fp: typing.TextIO, descriptions: list[str] | None = None):
+    """
+    Stream CSV format for Google Maps import into `fp`, which should be opened with `newline=""`.
 
-        for place in map_.places:
-            row = {
-                "Name": place.name,
-                "Latitude": place.lat,
-                "Longitude": place.lon,
-                "Description": _pairs_to_csv(place.desc),
-            }
+    `descriptions` are pre-rendered with `_pairs_to_csv`, one per place, if given.
+    """
+    if descriptions is None:
+        descriptions = [_pairs_to_csv(place.desc) for place in map_.places]
+    writer = csv.writer(fp)
+    writer.writerow(CSV_COLUMNS)
+    writer.writerows(
+        (place.name, place.lat, place.lon, description) for place, description in zip(map_.places, descriptions)
+    )
 
-            writer.writerow(row)
 
-    return fp.getvalue()
+def to_csv(map_: Map, descriptions: list[str] | None = None):
+    """
+    Produce CSV format for Google Maps import
+    """
+    with io.StringIO(newline="") as fp:
+        write_csv(map_, fp, descriptions=descriptions)
+        return fp.getvalue()
 
 
 SUBSTYLES = ["normal", "highlight"]
@@ -53,10 +63,17 @@ def to_kml(
     map_: Map,
     embed_dataurl_icons: bool = True,
     name: str = "Shelters",
+    descriptions: list[str] | None = None,
 ):
     """
     Produce KML format for Google Maps import
+
+    `descriptions` are pre-rendered with `_pairs_to_html`, one per place, if given.
     """
+    from xml.dom.minidom import Document
+
+    if descriptions is None:
+        descriptions = [_pairs_to_html(place.desc) for place in map_.places]
     doc = Document()
 
     def make_el(parent, tag, attrs=None, text=None, cdata=None):
@@ -116,12 +133,12 @@ def to_kml(
         style_map[icon] = style_map_id
 
     # Add placemarks for each feature
-    for place in map_.places:
+    for place, description in zip(map_.places, descriptions):
         placemark_elem = make_el(document_elem, "Placemark")
 
         style_id = style_map.get(place.icon)
         make_el(placemark_elem, "name", text=place.name)
-        make_el(placemark_elem, "description", cdata=_pairs_to_html(place.desc))
+        make_el(placemark_elem, "description", cdata=description)
         make_el(placemark_elem, "styleUrl", text=f"#{style_id}")
 
         point_elem = make_el(placemark_elem, "Point")
@@ -139,81 +156,259 @@ def _pairs_to_html(pairs):
     return "".join(f"<b>{k}:</b> {v}<br/>" for k, v in pairs)
 
 
-def dump_kmz(contents, path, attachments):
-    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
-        with archive.open("doc.kml", "w") as fp:
-            if isinstance(contents, str):
-                with io.TextIOWrapper(fp, encoding="utf-8") as tfp:
-                    tfp.write(contents)
+def dump_kmz(
+    contents,
+    path,
+    attachments,
+    compresslevel: int = kmz.DEFAULT_COMPRESSLEVEL,
+    workers: int | None = None,
+):
+    if isinstance(contents, str):
+        contents = contents.encode("utf-8")
+    kmz.write_zip(path, {"doc.kml": contents, **attachments}, compresslevel=compresslevel, workers=workers)
+
+
+FORMATS = ["csv", "kml", "kmz"]
+# Names of the outputs of `export`, e.g. "tel_aviv_shelters.2.kmz"
+OUTPUT_NAME_PATTERN = re.compile(rf"(?P<city>\w+)_shelters(?:\.\d+)?\.(?:{'|'.join(FORMATS)})")
+
+
+def export(
+    map_: Map,
+    name: str,
+    out_dir: Path,
+    base_name: str,
+    formats: str | list[str],
+    max_per_file: int = 2_000,
+    compresslevel: int = kmz.DEFAULT_COMPRESSLEVEL,
+    compress_workers: int | None = None,
+):
+    """
+    Write each part of the map in every requested format, so a single generated map fans out to all writers
+    """
+    return export_places(
+        icons=map_.icons,
+        places=map_.places,
+        name=name,
+        out_dir=out_dir,
+        base_name=base_name,
+        formats=formats,
+        max_per_file=max_per_file,
+        compresslevel=compresslevel,
+        compress_workers=compress_workers,
+    )
+
+
+def _drain(items: deque) -> typing.Iterator:
+    while items:
+        yield items.popleft()
+
+
+def export_places(
+    icons: list[Icon],
+    places: typing.Iterable[Place],
+    name: str,
+    out_dir: Path,
+    base_name: str,
+    formats: str | list[str],
+    max_per_file: int = 2_000,
+    compresslevel: int = kmz.DEFAULT_COMPRESSLEVEL,
+    compress_workers: int | None = None,
+):
+    """
+    Like `export`, but `places` may be a lazy iterator: parts are taken from it, written and released one at a time,
+    so at most `max_per_file` places (plus one looked ahead, and one rendered part) are held in memory.
+    """
+    if isinstance(formats, str):
+        formats = [formats]
+    formats = list(dict.fromkeys(formats))
+
+    # Look one place past the first part, as a map that fits in a single part is written without a part number. The
+    # places looked ahead at are popped as they're consumed, so they aren't kept alive until the end.
+    places = iter(places)
+    lookahead = deque(islice(places, max_per_file + 1))
+    is_split = len(lookahead) > max_per_file
+    parts = iter_batches(chain(_drain(lookahead), places), max_per_file)
+
+    hasher = MapHasher(icons)
+    num_files = 0
+    for num_files, part_places in enumerate(parts, start=1):
+        suffix = f".{num_files}" if is_split else ""
+        name_of_part = f"{name} ({num_files})" if is_split else name
+        map_part = Map(icons=icons, places=part_places)
+        with span("map_hash"):
+            hasher.update(map_part.places)
+        # Descriptions are rendered once per place and shared by the writers using the same rendering
+        descriptions = {}
+        for format in formats:
+            out_path = out_dir / f"{base_name}{suffix}.{format}"
+            render_pairs = _pairs_to_csv if format == "csv" else _pairs_to_html
+            if render_pairs not in descriptions:
+                with span("describe"):
+                    descriptions[render_pairs] = [render_pairs(place.desc) for place in map_part.places]
+            if format == "csv":
+                with span("write_csv"), atomic_open(out_path, "wt", encoding="utf-8", newline="") as fp:
+                    write_csv(map_=map_part, fp=fp, descriptions=descriptions[render_pairs])
+                count("bytes_out", out_path.stat().st_size)
+            elif format in {"kml", "kmz"}:
+                with span("to_kml"):
+                    contents, attachments = to_kml(
+                        map_=map_part,
+                        embed_dataurl_icons=format == "kml",
+                        name=name_of_part,
+                        descriptions=descriptions[render_pairs],
+                    )
+                if format == "kml":
+                    assert not attachments
+                    with span("dump"):
+                        dump(contents, out_path)
+                elif format == "kmz":
+                    with span("dump_kmz"):
+                        dump_kmz(
+                            contents,
+                            out_path,
+                            attachments=attachments,
+                            compresslevel=compresslevel,
+                            workers=compress_workers,
+                        )
+                    count("bytes_out", out_path.stat().st_size)
             else:
-                fp.write(contents)
-
-        for path, attachment_contents in attachments.items():
-            with archive.open(path, "w") as fp:
-                fp.write(attachment_contents)
-
-
-def export(map_: Map, name: str, out_dir: Path, base_name: str, format: str, max_per_file: int = 2_000):
-    num_files = (len(map_.places) - 1) // max_per_file + 1
-    logger.debug("Exporting %s map into %s files.", name, num_files)
-    digest = b""
-    for file_idx in range(num_files):
-        suffix = "" if num_files == 1 else f".{file_idx + 1}"
-        name_of_part = name if num_files == 1 else f"{name} ({file_idx + 1})"
-        out_path = out_dir / f"{base_name}{suffix}.{format}"
-        map_part = Map(icons=map_.icons, places=map_.places[file_idx * max_per_file : (file_idx + 1) * max_per_file])
-        if format == "csv":
-            dump(to_csv(map_=map_part), out_path)
-        elif format in {"kml", "kmz"}:
-            contents, attachments = to_kml(map_=map_part, embed_dataurl_icons=format == "kml", name=name_of_part)
-            if format == "kml":
-                assert not attachments
-                dump(contents, out_path)
-            elif format == "kmz":
-                dump_kmz(contents, out_path, attachments=attachments)
-        else:  # both
-            raise NotImplementedError("Invalid format")
-
-        print(f"Output to: {out_path.as_posix()}")
-        digest += map_hash(map_)
-    print(f"Hash: {out_path.name}:{digest.hex()}")
+                raise NotImplementedError("Invalid format")
+
+            print(f"Output to: {out_path.as_posix()}")
+
+    logger.debug("Exported %s map into %s files per format (%s).", name, num_files, ", ".join(formats))
+    for format in formats:
+        _remove_stale_parts(out_dir, base_name, format, num_files)
+    # The digest has always been one hash of the whole map per part; it doesn't depend on the format, so it's
+    # computed once and shared.
+    digest = hasher.digest() * num_files
+    print(f"Hash: {base_name}:{digest.hex()}")
     return digest
 
 
-def map_hash(map_: Map) -> str:
-    icon_lookup = {icon.url: index for index, icon in enumerate(map_.icons)}
-
-    return hashlib.sha256(
-        json.dumps(
-            {
-                "icons": [{"label": icon.label, "url": icon.url} for icon in map_.icons],
-                "places": [
-                    {
-                        "name": place.name,
-                        "desc": [(str(k), str(v)) for k, v in place.desc],
-                        "icon": icon_lookup[place.icon.url],
-                        "lon": float(place.lon),
-                        "lat": float(place.lat),
-                    }
-                    for place in map_.places
-                ],
-            },
-            ensure_ascii=False,
-            separators=(",", ":"),
-            sort_keys=True,
-        ).encode("utf-8")
-    ).digest()
+def _counted(places: typing.Iterable[Place], counter: str) -> typing.Iterator[Place]:
+    for place in places:
+        count(counter)
+        yield place
+
+
+def _output_city(file_name: str) -> str | None:
+    match = OUTPUT_NAME_PATTERN.fullmatch(file_name)
+    return match["city"] if match else None
+
+
+def _remove_stale_parts(out_dir: Path, base_name: str, format: str, num_files: int):
+    """
+    Remove parts left over from a previous export that was split into a different number of files
+    """
+    part_pattern = re.compile(rf"{re.escape(base_name)}\.(\d+)\.{format}")
+    for path in out_dir.glob(f"{base_name}.*"):
+        match = part_pattern.fullmatch(path.name)
+        is_stale_part = match is not None and (num_files == 1 or int(match.group(1)) > num_files)
+        is_stale_whole = path.name == f"{base_name}.{format}" and num_files != 1
+        if is_stale_part or is_stale_whole:
+            logger.debug("Removing stale output: %s", path)
+            path.unlink()
+
+
+_HASH_JSON_OPTIONS = dict(ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+
+
+class MapHasher:
+    """
+    Incremental `map_hash`, fed the places a batch at a time
+    """
+
+    def __init__(self, icons: list[Icon]):
+        self._icon_lookup = {icon.url: index for index, icon in enumerate(icons)}
+        self._hash = hashlib.sha256()
+        self._has_places = False
+        icons_json = json.dumps([{"label": icon.label, "url": icon.url} for icon in icons], **_HASH_JSON_OPTIONS)
+        # Same bytes as json.dumps({"icons": ..., "places": [...]}, **_HASH_JSON_OPTIONS), written piecewise
+        self._hash.update(f'{{"icons":{icons_json},"places":['.encode("utf-8"))
+
+    def update(self, places: typing.Iterable[Place]):
+        places_json = ",".join(
+            json.dumps(
+                {
+                    "name": place.name,
+                    "desc": [(str(k), str(v)) for k, v in place.desc],
+                    "icon": self._icon_lookup[place.icon.url],
+                    "lon": float(place.lon),
+                    "lat": float(place.lat),
+                },
+                **_HASH_JSON_OPTIONS,
+            )
+            for place in places
+        )
+        if places_json:
+            self._hash.update(f"{',' if self._has_places else ''}{places_json}".encode("utf-8"))
+            self._has_places = True
+
+    def digest(self) -> bytes:
+        hash_ = self._hash.copy()
+        hash_.update(b"]}")
+        return hash_.digest()
+
+
+def map_hash(map_: Map) -> bytes:
+    hasher = MapHasher(map_.icons)
+    hasher.update(map_.places)
+    return hasher.digest()
 
 
 def main():
     parser = argparse.ArgumentParser(description="Dump Google Maps formats")
     parser.add_argument("--data-dir", help="Path to data dir", default="data")
-    parser.add_argument("--format", help="Output format", choices=["csv", "kml", "kmz"], default="kml")
+    parser.add_argument(
+        "--format",
+        help="Output format(s); all are rendered from the same generated map",
+        nargs="+",
+        choices=FORMATS,
+        default=["kml"],
+    )
+    parser.add_argument(
+        "--cities",
+        help="Cities to export (only these are loaded)",
+        nargs="+",
+        default=["all"],
+        choices=CITY_KEYS + ["all"],
+    )
+    parser.add_argument(
+        "--compresslevel",
+        help="KMZ deflate level (0 stores uncompressed, 9 is smallest)",
+        type=int,
+        choices=range(10),
+        default=kmz.DEFAULT_COMPRESSLEVEL,
+    )
+    parser.add_argument("--compress-workers", help="KMZ compression threads (default: CPU count)", type=int)
+    parser.add_argument(
+        "--change-feed",
+        action="store_true",
+        help="Also write the changes since the previous run's snapshot (JSON, CSV and KML of changed places)",
+    )
+    parser.add_argument(
+        "--publish-dir",
+        help="Write outputs into a new version under this directory and atomically point its `current` link at it",
+    )
+    parser.add_argument(
+        "--keep",
+        help="Number of published versions to retain (with --publish-dir)",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--memory-budget",
+        help="Stream records from disk and write parts as they fill, to stay within roughly this many MB",
+        type=int,
+    )
     parser.add_argument(
         "--verbose",
         action="store_true",
         help="Enable verbose logging",
     )
+    metrics.add_arguments(parser)
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -221,29 +416,93 @@ def main():
         format="%(levelname)s:%(name)s:%(message)s",
     )
 
-    format = args.format
-    if format not in {"kml", "kmz", "csv"}:
-        parser.error("Output file extension should be .kml or .csv")
+    formats = args.format
+    city_keys = CITY_KEYS if "all" in args.cities else args.cities
 
     data_dir = Path(args.data_dir)
 
     combined_hash = hashlib.sha256()
 
-    for city in all_cities:
-        logger.debug("Exporting map for: %s", city.NAME)
-        try:
-            city_map = city.generate_map(data_dir)
-            module_name = city.__name__.rsplit(".", 1)[-1]
-            digest = export(
-                map_=city_map,
-                name=f"{city.NAME} Shelters",
-                out_dir=data_dir,
-                base_name=f"{module_name}_shelters",
-                format=format,
-            )
-            combined_hash.update(digest)
-        except Exception:
-            logger.exception("Failed to export map for: %s", city.NAME)
+    if args.keep < 1:
+        parser.error("--keep should be at least 1")
+    if args.memory_budget is not None and args.change_feed:
+        parser.error("--change-feed needs whole maps in memory and can't be combined with --memory-budget")
+
+    with (
+        metrics.instrument(args, out_dir=data_dir, name="convert"),
+        publish(args.publish_dir, keep=args.keep) if args.publish_dir else nullcontext(data_dir) as out_dir,
+    ):
+        skipped_cities = [module_name for module_name in CITY_KEYS if module_name not in city_keys]
+        if args.publish_dir and skipped_cities:
+            # A version has to hold every city, so the outputs of the cities left out are carried over from the
+            # current one. Their change feeds aren't: nothing changed for those cities in this version.
+            link_from_current(args.publish_dir, out_dir, include=lambda name: _output_city(name) in skipped_cities)
+
+        failed = []
+        snapshots = {}
+        for module_name in city_keys:
+            logger.debug("Exporting map for: %s", module_name)
+            try:
+                city = load_city(module_name)
+                if args.memory_budget is not None:
+                    with span(city.NAME):
+                        icons, places = city.iter_map(
+                            data_dir, batch_size=batch_size_for_memory_budget(args.memory_budget)
+                        )
+                        digest = export_places(
+                            icons=icons,
+                            places=_counted(places, f"places.{module_name}"),
+                            name=f"{city.NAME} Shelters",
+                            out_dir=out_dir,
+                            base_name=f"{module_name}_shelters",
+                            formats=formats,
+                            compresslevel=args.compresslevel,
+                            compress_workers=args.compress_workers,
+                        )
+                    combined_hash.update(digest)
+                    continue
+                with span(city.NAME):
+                    with span("generate_map"):
+                        city_map = city.generate_map(data_dir)
+                    count(f"places.{module_name}", len(city_map.places))
+                    digest = export(
+                        map_=city_map,
+                        name=f"{city.NAME} Shelters",
+                        out_dir=out_dir,
+                        base_name=f"{module_name}_shelters",
+                        formats=formats,
+                        compresslevel=args.compresslevel,
+                        compress_workers=args.compress_workers,
+                    )
+                    if args.change_feed:
+                        from . import diff
+
+                        with span("change_feed"):
+                            _, snapshots[module_name] = diff.update_change_feed(
+                                map_=city_map,
+                                name=f"{city.NAME} Shelters",
+                                data_dir=data_dir,
+                                out_dir=out_dir,
+                                base_name=f"{module_name}_shelters",
+                                render_kml=to_kml,
+                                ignored_labels=getattr(city, "DIFF_IGNORED_LABELS", frozenset()),
+                            )
+                combined_hash.update(digest)
+            except Exception:
+                logger.exception("Failed to export map for: %s", module_name)
+                count("failed_cities")
+                failed.append(module_name)
+
+        if failed and args.publish_dir:
+            # Keep serving the previous version rather than one that is missing cities
+            raise RuntimeError(f"Not publishing, failed to export: {', '.join(failed)}")
+
+    if snapshots:
+        from . import diff
+
+        # Only advance the snapshots once the feeds computed against them have been published
+        for module_name, snapshot in snapshots.items():
+            diff.save_snapshot(snapshot, data_dir=data_dir, base_name=f"{module_name}_shelters")
 
     print("Combined hash:", combined_hash.hexdigest())
 
@@ -0,0 +1,226 @@
+"""
+Validation and bulk reprojection of shelter coordinates.
+
+Source datasets don't agree on how they give coordinates: some columns are named the other way around from what
+they contain, and ArcGIS layers often return Israeli Transverse Mercator (ITM, EPSG:2039) rather than WGS84. The
+values alone tell them apart within Israel, since latitudes, longitudes and ITM metres fall in disjoint ranges, so
+`fix_coordinates` classifies every point of a city at once, reprojects all the ITM ones in a single batch (offline,
+no network calls), and drops those that fall outside the city.
+"""
+
+import logging
+import math
+from collections import Counter
+
+from .metrics import count
+
+logger = logging.getLogger(__name__)
+
+# (lon, lat) polygon
+Polygon = list[tuple[float, float]]
+
+# Ranges of plausible values anywhere in Israel
+LAT_RANGE = (29.0, 34.0)
+LON_RANGE = (34.0, 36.0)
+ITM_EASTING_RANGE = (100_000.0, 300_000.0)
+ITM_NORTHING_RANGE = (350_000.0, 850_000.0)
+
+# ITM, on the GRS80 ellipsoid
+GRS80_A = 6378137.0
+GRS80_F = 1 / 298.257222101
+ITM_LAT0 = math.radians(31 + 44 / 60 + 3.817 / 3600)
+ITM_LON0 = math.radians(35 + 12 / 60 + 16.261 / 3600)
+ITM_K0 = 1.0000067
+ITM_FALSE_EASTING = 219529.584
+ITM_FALSE_NORTHING = 626907.39
+# Israel 1993 -> WGS84 (EPSG:9676, "Israel 1993 to WGS 84 (2)"): metres, arc-seconds and ppm. EPSG gives the
+# rotations in the coordinate frame convention; they're negated here for the position vector formula below.
+ITM_TO_WGS84 = (23.772, 17.49, 17.859, -0.3132, -1.85274, 1.67299, -5.4262)
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+
+COORDINATE_STATUSES = ["ok", "swapped", "reprojected", "missing", "invalid", "out_of_bounds"]
+
+
+def _in_range(value: float, bounds: tuple[float, float]) -> bool:
+    return bounds[0] <= value <= bounds[1]
+
+
+def _meridian_arc(lat: float, a: float, e2: float) -> float:
+    e4 = e2 * e2
+    e6 = e4 * e2
+    return a * (
+        (1 - e2 / 4 - 3 * e4 / 64 - 5 * e6 / 256) * lat
+        - (3 * e2 / 8 + 3 * e4 / 32 + 45 * e6 / 1024) * math.sin(2 * lat)
+        + (15 * e4 / 256 + 45 * e6 / 1024) * math.sin(4 * lat)
+        - (35 * e6 / 3072) * math.sin(6 * lat)
+    )
+
+
+def itm_to_wgs84(points: list[tuple[float, float]]) -> list[tuple[float, float]]:
+    """
+    Convert ITM (easting, northing) pairs into WGS84 (lon, lat) degrees.
+
+    Inverse transverse Mercator (Snyder's series) on GRS80, then a 7-parameter Helmert shift to WGS84. Constants are
+    computed once per batch. Results agree with PROJ's EPSG:2039 -> EPSG:4326 (via EPSG:9676) to under a millimetre;
+    the datum shift itself is accurate to about half a metre.
+    """
+    a, f = GRS80_A, GRS80_F
+    e2 = f * (2 - f)
+    ep2 = e2 / (1 - e2)
+    e1 = (1 - math.sqrt(1 - e2)) / (1 + math.sqrt(1 - e2))
+    mu_factor = a * (1 - e2 / 4 - 3 * e2 * e2 / 64 - 5 * e2**3 / 256)
+    m0 = _meridian_arc(ITM_LAT0, a, e2)
+    j1 = 3 * e1 / 2 - 27 * e1**3 / 32
+    j2 = 21 * e1**2 / 16 - 55 * e1**4 / 32
+    j3 = 151 * e1**3 / 96
+    j4 = 1097 * e1**4 / 512
+
+    tx, ty, tz, rx, ry, rz, ds = ITM_TO_WGS84
+    rx, ry, rz = (math.radians(r / 3600) for r in (rx, ry, rz))
+    scale = 1 + ds * 1e-6
+    wgs84_e2 = WGS84_F * (2 - WGS84_F)
+    wgs84_b = WGS84_A * (1 - WGS84_F)
+    wgs84_ep2 = (WGS84_A**2 - wgs84_b**2) / wgs84_b**2
+
+    results = []
+    for easting, northing in points:
+        # footpoint latitude
+        mu = (m0 + (northing - ITM_FALSE_NORTHING) / ITM_K0) / mu_factor
+        phi1 = mu + j1 * math.sin(2 * mu) + j2 * math.sin(4 * mu) + j3 * math.sin(6 * mu) + j4 * math.sin(8 * mu)
+        sin1, cos1, tan1 = math.sin(phi1), math.cos(phi1), math.tan(phi1)
+        c1 = ep2 * cos1 * cos1
+        t1 = tan1 * tan1
+        n1 = a / math.sqrt(1 - e2 * sin1 * sin1)
+        r1 = a * (1 - e2) / (1 - e2 * sin1 * sin1) ** 1.5
+        d = (easting - ITM_FALSE_EASTING) / (n1 * ITM_K0)
+        lat = phi1 - (n1 * tan1 / r1) * (
+            d**2 / 2
+            - (5 + 3 * t1 + 10 * c1 - 4 * c1 * c1 - 9 * ep2) * d**4 / 24
+            + (61 + 90 * t1 + 298 * c1 + 45 * t1 * t1 - 252 * ep2 - 3 * c1 * c1) * d**6 / 720
+        )
+        lon_series = (
+            d
+            - (1 + 2 * t1 + c1) * d**3 / 6
+            + (5 - 2 * c1 + 28 * t1 - 3 * c1 * c1 + 8 * ep2 + 24 * t1 * t1) * d**5 / 120
+        )
+        lon = ITM_LON0 + lon_series / cos1
+
+        # GRS80 geodetic -> geocentric, Helmert shift, geocentric -> WGS84 geodetic (Bowring)
+        n = a / math.sqrt(1 - e2 * math.sin(lat) ** 2)
+        x = n * math.cos(lat) * math.cos(lon)
+        y = n * math.cos(lat) * math.sin(lon)
+        z = n * (1 - e2) * math.sin(lat)
+        x, y, z = (
+            tx + scale * (x - rz * y + ry * z),
+            ty + scale * (rz * x + y - rx * z),
+            tz + scale * (-ry * x + rx * y + z),
+        )
+        p = math.hypot(x, y)
+        theta = math.atan2(z * WGS84_A, p * wgs84_b)
+        lat = math.atan2(
+            z + wgs84_ep2 * wgs84_b * math.sin(theta) ** 3,
+            p - wgs84_e2 * WGS84_A * math.cos(theta) ** 3,
+        )
+        lon = math.atan2(y, x)
+        results.append((math.degrees(lon), math.degrees(lat)))
+    return results
+
+
+def point_in_polygon(lon: float, lat: float, polygon: Polygon) -> bool:
+    inside = False
+    for (lon1, lat1), (lon2, lat2) in zip(polygon, polygon[1:] + polygon[:1]):
+        if (lat1 > lat) != (lat2 > lat) and lon < (lon2 - lon1) * (lat - lat1) / (lat2 - lat1) + lon1:
+            inside = not inside
+    return inside
+
+
+def classify(lon: float, lat: float) -> str:
+    """
+    Tell how a (lon, lat) pair as given by the source is actually laid out
+    """
+    if _in_range(lon, LON_RANGE) and _in_range(lat, LAT_RANGE):
+        return "ok"
+    if _in_range(lat, LON_RANGE) and _in_range(lon, LAT_RANGE):
+        return "swapped"
+    if _in_range(lon, ITM_EASTING_RANGE) and _in_range(lat, ITM_NORTHING_RANGE):
+        return "itm"
+    if _in_range(lat, ITM_EASTING_RANGE) and _in_range(lon, ITM_NORTHING_RANGE):
+        return "itm_swapped"
+    return "invalid"
+
+
+# Returned by `_to_float` for values that are present but aren't a usable number
+UNPARSABLE = object()
+
+
+def _to_float(value) -> float | None | object:
+    """
+    Parse a raw coordinate, returning None if it's missing and `UNPARSABLE` if it isn't a finite number
+    """
+    if value is None or value == "":
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return UNPARSABLE
+    return value if math.isfinite(value) else UNPARSABLE
+
+
+def fix_coordinates(
+    points: list[tuple[float | str | None, float | str | None]],
+    bounds: Polygon | None = None,
+) -> tuple[list[tuple[float, float] | None], Counter[str]]:
+    """
+    Validate a batch of (lon, lat) pairs as given by a source.
+
+    Swapped axes are swapped back and ITM coordinates are reprojected to WGS84. Returns the fixed (lon, lat) pairs,
+    with None for points that are missing, unusable or outside `bounds`, and the number of points per status (see
+    `COORDINATE_STATUSES`).
+    """
+    statuses = Counter()
+    results: list[tuple[float, float] | None] = [None] * len(points)
+    kinds: list[str | None] = [None] * len(points)
+    itm_indices = []
+    itm_points = []
+    for index, (raw_lon, raw_lat) in enumerate(points):
+        lon, lat = _to_float(raw_lon), _to_float(raw_lat)
+        if lon is None or lat is None:
+            statuses["missing"] += 1
+            continue
+        if lon is UNPARSABLE or lat is UNPARSABLE:
+            statuses["invalid"] += 1
+            continue
+        kind = classify(lon, lat)
+        if kind == "ok":
+            results[index] = (lon, lat)
+        elif kind == "swapped":
+            results[index] = (lat, lon)
+        elif kind in {"itm", "itm_swapped"}:
+            itm_indices.append(index)
+            itm_points.append((lon, lat) if kind == "itm" else (lat, lon))
+        else:
+            statuses["invalid"] += 1
+            continue
+        kinds[index] = kind
+
+    for index, point in zip(itm_indices, itm_to_wgs84(itm_points)):
+        results[index] = point
+        kinds[index] = "reprojected"
+
+    for index, point in enumerate(results):
+        if point is None:
+            continue
+        if bounds is not None and not point_in_polygon(*point, bounds):
+            results[index] = None
+            statuses["out_of_bounds"] += 1
+        else:
+            statuses[kinds[index]] += 1
+
+    return results, statuses
+
+
+def report_coordinates(name: str, statuses: Counter[str]):
+    logger.info("Coordinates for %s: %s", name, {status: statuses[status] for status in COORDINATE_STATUSES})
+    for status in COORDINATE_STATUSES:
+        count(f"coordinates.{status}", statuses[status])
@@ -0,0 +1,162 @@
+"""
+Change feed between successive snapshots of a city's generated map.
+
+Every place is keyed by a stable per-city identifier (`Place.key`) and reduced to a record whose hash is stored in
+`{base_name}_snapshot.json`. The next run only has to compare hashes to find what was added, removed, moved or
+otherwise changed, and publishes just those places.
+"""
+
+import csv
+import hashlib
+import io
+import json
+import logging
+from collections import Counter
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from .common import Map, dump, load
+
+logger = logging.getLogger(__name__)
+
+COORDINATE_DIGITS = 6
+CHANGE_KINDS = ["added", "removed", "moved", "changed"]
+
+
+@dataclass
+class Change:
+    key: str
+    kind: str  # one of CHANGE_KINDS
+    fields: list[str]
+    before: dict | None
+    after: dict | None
+
+
+def place_records(map_: Map, ignored_labels: frozenset[str] = frozenset()) -> dict[str, dict]:
+    """
+    Reduce each place to a JSON-serializable record, keyed by `Place.key`.
+
+    Places without a key fall back to their name and coordinates, and repeated keys get a "#n" suffix, so that every
+    place is tracked.
+    """
+    records = {}
+    key_counts = Counter()
+    for place in map_.places:
+        lon = round(float(place.lon), COORDINATE_DIGITS)
+        lat = round(float(place.lat), COORDINATE_DIGITS)
+        key = str(place.key) if place.key not in (None, "") else f"{place.name}@{lon},{lat}"
+        key_counts[key] += 1
+        if key_counts[key] > 1:
+            key = f"{key}#{key_counts[key]}"
+        records[key] = {
+            "name": place.name,
+            "icon": place.icon.label,
+            "lon": lon,
+            "lat": lat,
+            "desc": {str(k): str(v) for k, v in place.desc if k not in ignored_labels},
+        }
+    return records
+
+
+def record_hash(record: dict) -> str:
+    return hashlib.sha256(
+        json.dumps(record, ensure_ascii=False, separators=(",", ":"), sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def changed_fields(before: dict, after: dict) -> list[str]:
+    fields = [field for field in ("name", "icon") if before[field] != after[field]]
+    if (before["lon"], before["lat"]) != (after["lon"], after["lat"]):
+        fields.append("coordinates")
+    fields.extend(
+        label
+        for label in sorted(before["desc"].keys() | after["desc"].keys())
+        if before["desc"].get(label) != after["desc"].get(label)
+    )
+    return fields
+
+
+def diff_snapshots(previous: dict[str, list], current: dict[str, list]) -> list[Change]:
+    """
+    Compare two snapshots, each mapping a key to `[hash, record]`
+    """
+    changes = []
+    for key, (digest, record) in current.items():
+        if key not in previous:
+            changes.append(Change(key=key, kind="added", fields=[], before=None, after=record))
+            continue
+        previous_digest, previous_record = previous[key]
+        if digest == previous_digest:
+            continue
+        fields = changed_fields(previous_record, record)
+        kind = "moved" if fields == ["coordinates"] else "changed"
+        changes.append(Change(key=key, kind=kind, fields=fields, before=previous_record, after=record))
+    for key, (_, record) in previous.items():
+        if key not in current:
+            changes.append(Change(key=key, kind="removed", fields=[], before=record, after=None))
+    return changes
+
+
+def changes_to_csv(changes: list[Change]):
+    with io.StringIO(newline="") as fp:
+        writer = csv.writer(fp)
+        writer.writerow(["Key", "Change", "Fields", "Name", "Latitude", "Longitude"])
+        for change in changes:
+            record = change.after or change.before
+            writer.writerow(
+                [change.key, change.kind, " | ".join(change.fields), record["name"], record["lat"], record["lon"]]
+            )
+        return fp.getvalue()
+
+
+def update_change_feed(
+    map_: Map,
+    name: str,
+    data_dir: Path,
+    out_dir: Path,
+    base_name: str,
+    render_kml: Callable[..., tuple[bytes, dict]],
+    ignored_labels: frozenset[str] = frozenset(),
+) -> tuple[list[Change], dict]:
+    """
+    Compare `map_` against the previous snapshot in `data_dir`, and write the change feed (JSON and CSV) and a KML of
+    the added and modified places (rendered by `render_kml`, e.g. `convert.to_kml`) into `out_dir`.
+
+    Returns the changes and the new snapshot. The snapshot isn't replaced here: pass it to `save_snapshot` once the
+    feed has been published, so the next feed is computed against what consumers have actually received. Without a
+    previous snapshot, every place is reported as added.
+    """
+    snapshot_path = get_snapshot_path(data_dir, base_name)
+    records = place_records(map_, ignored_labels=ignored_labels)
+    current = {key: [record_hash(record), record] for key, record in records.items()}
+    previous = load(snapshot_path)["places"] if snapshot_path.exists() else {}
+    if not previous:
+        logger.info("No previous snapshot for %s at %s", name, snapshot_path)
+
+    changes = diff_snapshots(previous, current)
+    summary = Counter(change.kind for change in changes)
+    logger.info("Changes for %s: %s", name, dict(summary))
+
+    feed = {
+        "name": name,
+        "summary": {kind: summary[kind] for kind in CHANGE_KINDS},
+        "changes": [asdict(change) for change in changes],
+    }
+    dump(json.dumps(feed, ensure_ascii=False, separators=(",", ":")), out_dir / f"{base_name}_changes.json")
+    dump(changes_to_csv(changes), out_dir / f"{base_name}_changes.csv")
+
+    changed_keys = {change.key for change in changes if change.kind != "removed"}
+    changed_places = [place for key, place in zip(records, map_.places) if key in changed_keys]
+    contents, _ = render_kml(Map(icons=map_.icons, places=changed_places), name=f"{name} (changes)")
+    dump(contents, out_dir / f"{base_name}_changes.kml")
+
+    return changes, {"name": name, "places": current}
+
+
+def get_snapshot_path(data_dir: Path, base_name: str) -> Path:
+    return data_dir / f"{base_name}_snapshot.json"
+
+
+def save_snapshot(snapshot: dict, data_dir: Path, base_name: str):
+    dump(json.dumps(snapshot, ensure_ascii=False, separators=(",", ":")), get_snapshot_path(data_dir, base_name))
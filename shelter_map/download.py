@@ -2,48 +2,74 @@ import argparse
 import logging
 from pathlib import Path
 
-from .by_city import all_cities
-from .common import City, get_city_key
+from . import metrics
+from .by_city import CITY_KEYS, load_city
+from .common import City
+from .metrics import span
 
 
 logger = logging.getLogger(__name__)
 
 
-def main(out_dir: str | Path = "data", city_modules: list[City] = all_cities):
+def main(
+    out_dir: str | Path = "data",
+    city_modules: list[City] | None = None,
+    pipelined: bool = False,
+    memory_budget: int | None = None,
+):
     out_dir = Path(out_dir)
+    if city_modules is None:
+        city_modules = [load_city(key) for key in CITY_KEYS]
     for module in city_modules:
         name = getattr(module, "NAME", str(module))
         logger.info("Downloading data for %s", name)
         try:
-            module.download_data(out_dir)
+            with span(name):
+                module.download_data(out_dir, pipelined=pipelined, memory_budget=memory_budget)
             logger.debug("Finished downloading data for %s", name)
         except Exception:
             logger.exception("Failed to download data for %s", name)
+            metrics.count("failed_cities")
 
     logger.info("Done")
 
 
 if __name__ == "__main__":
-    all_cities_map = {get_city_key(module): module for module in all_cities}
-
     parser = argparse.ArgumentParser()
     parser.add_argument("--out-dir", default="data")
-    parser.add_argument("--cities", nargs="+", default=["all"], choices=sorted(all_cities_map) + ["all"])
+    parser.add_argument("--cities", nargs="+", default=["all"], choices=sorted(CITY_KEYS) + ["all"])
+    parser.add_argument(
+        "--pipelined",
+        action="store_true",
+        help="Overlap downloading, geocoding and writing instead of running them one after the other",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        help="Stream downloads to disk and spill intermediate data, to stay within roughly this many MB",
+        type=int,
+    )
     parser.add_argument(
         "--verbose",
         action="store_true",
         help="Enable verbose logging",
     )
+    metrics.add_arguments(parser)
     args = parser.parse_args()
 
     cities = args.cities
     if "all" in cities:
-        cities = list(all_cities_map)
-    city_modules = [all_cities_map[name] for name in cities]
+        cities = CITY_KEYS
+    city_modules = [load_city(name) for name in cities]
 
     logging.basicConfig(
         level=logging.DEBUG if args.verbose else logging.INFO,
         format="%(levelname)s:%(name)s:%(message)s",
     )
 
-    main(out_dir=args.out_dir, city_modules=city_modules)
+    with metrics.instrument(args, out_dir=args.out_dir, name="download"):
+        main(
+            out_dir=args.out_dir,
+            city_modules=city_modules,
+            pipelined=args.pipelined,
+            memory_budget=args.memory_budget,
+        )
@@ -0,0 +1,151 @@
+"""
+A minimal ZIP writer for KMZ archives that deflates large entries in parallel blocks.
+
+The standard library's `zipfile` compresses every entry serially in one zlib stream. Here each entry is cut into
+blocks which are deflated concurrently (zlib releases the GIL) and then concatenated, the same way `pigz` does it:
+every block is primed with the last 32 KiB of the previous one as a preset dictionary and all but the last block end
+with a sync flush, so the result is a single ordinary raw deflate stream that any unzip tool (and Google Earth) reads.
+"""
+
+import os
+import struct
+import typing
+import zlib
+from contextlib import nullcontext
+from pathlib import Path
+
+from .common import atomic_open
+
+if typing.TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+DEFAULT_COMPRESSLEVEL = 6
+DEFAULT_BLOCK_SIZE = 1 << 20
+WINDOW_SIZE = 1 << 15
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+# 1980-01-01 00:00:00, like entries written by `zipfile.ZipFile.open(name, "w")`, so output stays reproducible
+DOS_TIME = 0
+DOS_DATE = (1 << 5) | 1
+
+
+def _deflate_block(data: memoryview, start: int, end: int, level: int, last: bool) -> bytes:
+    compressor = (
+        zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=data[max(0, start - WINDOW_SIZE) : start])
+        if start
+        else zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    )
+    return compressor.compress(data[start:end]) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def deflate(
+    data: bytes,
+    level: int = DEFAULT_COMPRESSLEVEL,
+    executor: "Executor | None" = None,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+):
+    """
+    Produce a raw deflate stream of `data`, compressing blocks of `block_size` bytes on `executor` if given
+    """
+    view = memoryview(data)
+    bounds = [(start, min(start + block_size, len(data))) for start in range(0, len(data), block_size)] or [(0, 0)]
+    args = [(view, start, end, level, index == len(bounds) - 1) for index, (start, end) in enumerate(bounds)]
+    if executor is None or len(args) == 1:
+        return b"".join(_deflate_block(*block_args) for block_args in args)
+    return b"".join(executor.map(lambda block_args: _deflate_block(*block_args), args))
+
+
+def write_zip(
+    path: str | Path,
+    entries: dict[str, bytes],
+    compresslevel: int = DEFAULT_COMPRESSLEVEL,
+    workers: int | None = None,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+):
+    """
+    Write `entries` (archive name -> contents, in order) into a ZIP file at `path`.
+
+    `compresslevel` 0 stores entries uncompressed. `workers` is the number of compression threads, defaulting to the
+    number of CPUs; 1 compresses serially.
+    """
+    # imported here so that importing this module (and convert) stays cheap for non-KMZ runs
+    from concurrent.futures import ThreadPoolExecutor
+
+    workers = workers or os.cpu_count() or 1
+    central_directory = []
+    with (
+        ThreadPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as executor,
+        atomic_open(path, "wb") as fp,
+    ):
+        for name, contents in entries.items():
+            encoded_name = name.encode("utf-8")
+            flags = 0 if encoded_name.isascii() else 0x800
+            crc = zlib.crc32(contents)
+            if compresslevel == 0:
+                method, compressed = ZIP_STORED, contents
+            else:
+                method = ZIP_DEFLATED
+                compressed = deflate(contents, level=compresslevel, executor=executor, block_size=block_size)
+            if len(compressed) >= 1 << 32 or len(contents) >= 1 << 32 or fp.tell() >= 1 << 32:
+                raise ValueError(f"Entry {name!r} requires ZIP64, which is not supported")
+
+            header_offset = fp.tell()
+            fp.write(
+                struct.pack(
+                    "<IHHHHHIIIHH",
+                    0x04034B50,
+                    20,  # version needed to extract
+                    flags,
+                    method,
+                    DOS_TIME,
+                    DOS_DATE,
+                    crc,
+                    len(compressed),
+                    len(contents),
+                    len(encoded_name),
+                    0,  # extra field length
+                )
+            )
+            fp.write(encoded_name)
+            fp.write(compressed)
+            central_directory.append(
+                struct.pack(
+                    "<IHHHHHHIIIHHHHHII",
+                    0x02014B50,
+                    20,  # version made by
+                    20,  # version needed to extract
+                    flags,
+                    method,
+                    DOS_TIME,
+                    DOS_DATE,
+                    crc,
+                    len(compressed),
+                    len(contents),
+                    len(encoded_name),
+                    0,  # extra field length
+                    0,  # comment length
+                    0,  # disk number
+                    0,  # internal attributes
+                    0,  # external attributes
+                    header_offset,
+                )
+                + encoded_name
+            )
+
+        directory_offset = fp.tell()
+        for record in central_directory:
+            fp.write(record)
+        fp.write(
+            struct.pack(
+                "<IHHHHIIH",
+                0x06054B50,
+                0,  # this disk
+                0,  # disk with the central directory
+                len(central_directory),
+                len(central_directory),
+                fp.tell() - directory_offset,
+                directory_offset,
+                0,  # comment length
+            )
+        )
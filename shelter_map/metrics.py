@@ -0,0 +1,150 @@
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+from . import __version__
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics:
+    """
+    Collects timed spans and counters for a single CLI run.
+
+    Spans nest: a span opened inside another one is recorded under the path of its parents (e.g.
+    "Tel Aviv/generate_map"), so the report can be grouped by city and by stage.
+    """
+
+    def __init__(self):
+        self.spans: list[dict] = []
+        self.counters: Counter[str] = Counter()
+        self.started_at = datetime.now(tz=timezone.utc)
+        self._stack: list[dict] = []
+        self._profiler = None
+        # Counters are also updated from worker threads (e.g. the pipelined download), and `+=` isn't atomic
+        self._counters_lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str):
+        parent = self._stack[-1] if self._stack else None
+        frame = dict(path=f"{parent['path']}/{name}" if parent else name, start_memory=0, peak_memory=0)
+        tracemalloc = _tracemalloc_if_tracing()
+        if tracemalloc:
+            # reset_peak() is global, so hand the peak seen so far to the parent before resetting it
+            current_memory, peak_memory = tracemalloc.get_traced_memory()
+            if parent:
+                parent["peak_memory"] = max(parent["peak_memory"], peak_memory)
+            tracemalloc.reset_peak()
+            frame["start_memory"] = frame["peak_memory"] = current_memory
+        self._stack.append(frame)
+
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self._stack.pop()
+            span = dict(
+                name=frame["path"],
+                seconds=round(time.perf_counter() - start, 6),
+                cpu_seconds=round(time.process_time() - start_cpu, 6),
+                ok=ok,
+            )
+            if tracemalloc:
+                peak_memory = max(frame["peak_memory"], tracemalloc.get_traced_memory()[1])
+                if parent:
+                    parent["peak_memory"] = max(parent["peak_memory"], peak_memory)
+                span["peak_memory_bytes"] = peak_memory - frame["start_memory"]
+            self.spans.append(span)
+            logger.debug("Span %s took %.3fs", span["name"], span["seconds"])
+
+    def count(self, name: str, value: int = 1):
+        with self._counters_lock:
+            self.counters[name] += value
+
+    def start_profiling(self, profile: bool = False, trace_memory: bool = False):
+        # both are imported lazily, to keep them off the startup path of the CLIs
+        if trace_memory:
+            import tracemalloc
+
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+        if profile:
+            import cProfile
+
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def stop_profiling(self, profile_path: str | Path | None = None):
+        if self._profiler is not None:
+            self._profiler.disable()
+            if profile_path is not None:
+                Path(profile_path).parent.mkdir(parents=True, exist_ok=True)
+                self._profiler.dump_stats(profile_path)
+                logger.info("Profile written to: %s", Path(profile_path).as_posix())
+            self._profiler = None
+
+    def report(self) -> dict:
+        report = {
+            "version": __version__,
+            "started_at": self.started_at.isoformat(),
+            "spans": self.spans,
+            "counters": dict(sorted(self.counters.items())),
+        }
+        if tracemalloc := _tracemalloc_if_tracing():
+            report["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        return report
+
+    def dump_report(self, path: str | Path):
+        # imported here, as common itself imports this module
+        from .common import atomic_open
+
+        path = Path(path)
+        with atomic_open(path, "wt", encoding="utf-8") as fp:
+            json.dump(self.report(), fp, indent=1, ensure_ascii=False)
+        logger.info("Metrics report written to: %s", path.as_posix())
+
+
+# Process-wide instance shared by the CLIs and the city modules
+metrics = Metrics()
+span = metrics.span
+count = metrics.count
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--metrics", action="store_true", help="Write a JSON metrics report next to the outputs")
+    parser.add_argument("--profile", action="store_true", help="Write cProfile stats next to the outputs")
+    parser.add_argument("--trace-memory", action="store_true", help="Record peak memory per span (slow)")
+
+
+@contextmanager
+def instrument(args: argparse.Namespace, out_dir: str | Path, name: str):
+    """
+    Run the body with profiling as requested by the arguments from `add_arguments`, writing `{name}_metrics.json`
+    and `{name}.prof` into `out_dir`.
+    """
+    out_dir = Path(out_dir)
+    metrics.start_profiling(profile=args.profile, trace_memory=args.trace_memory)
+    try:
+        with span(name):
+            yield metrics
+    finally:
+        metrics.stop_profiling(out_dir / f"{name}.prof" if args.profile else None)
+        if args.metrics:
+            metrics.dump_report(out_dir / f"{name}_metrics.json")
+        if tracemalloc := _tracemalloc_if_tracing():
+            tracemalloc.stop()
+
+
+def _tracemalloc_if_tracing():
+    tracemalloc = sys.modules.get("tracemalloc")
+    return tracemalloc if tracemalloc is not None and tracemalloc.is_tracing() else None
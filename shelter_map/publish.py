@@ -0,0 +1,129 @@
+"""
+Crash-safe publishing of outputs into versioned directories.
+
+    root/
+      current -> versions/20261019T030000123456Z
+      versions/
+        20261018T030000654321Z/
+        20261019T030000123456Z/
+
+Each run writes into a hidden temporary directory under `versions/`. Once everything is written it is synced, renamed
+to its final version name, and the `current` symlink is atomically swapped to point at it. Readers that resolve
+`current` always see a complete set of outputs, and never need to lock. Only the last `keep` versions are retained.
+Outputs that a run doesn't regenerate can be carried over from the current version with `link_from_current`.
+"""
+
+import logging
+import os
+import shutil
+import time
+from collections.abc import Callable
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+from .common import fsync_dir
+
+logger = logging.getLogger(__name__)
+
+VERSIONS_DIR = "versions"
+CURRENT_LINK = "current"
+TMP_PREFIX = "."
+TMP_SUFFIX = ".tmp"
+# Temporary directories left behind by crashed runs are removed once they are this old
+STALE_TMP_SECONDS = 24 * 60 * 60
+
+
+def _fsync_tree(path: Path):
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            with open(Path(dir_path) / file_name, "rb") as fp:
+                os.fsync(fp.fileno())
+        fsync_dir(dir_path)
+
+
+def list_versions(root: Path) -> list[Path]:
+    versions_dir = root / VERSIONS_DIR
+    if not versions_dir.is_dir():
+        return []
+    return sorted(path for path in versions_dir.iterdir() if path.is_dir() and not path.name.startswith(TMP_PREFIX))
+
+
+def current_version(root: Path) -> Path | None:
+    link = root / CURRENT_LINK
+    return link.resolve() if link.is_symlink() else None
+
+
+def swap_current(root: Path, version: Path):
+    link = root / CURRENT_LINK
+    tmp_link = root / f"{TMP_PREFIX}{CURRENT_LINK}.{os.getpid()}{TMP_SUFFIX}"
+    tmp_link.unlink(missing_ok=True)
+    os.symlink(version.relative_to(root), tmp_link, target_is_directory=True)
+    os.replace(tmp_link, link)
+    fsync_dir(root)
+
+
+def link_from_current(root: str | Path, out_dir: Path, include: Callable[[str], bool]) -> list[str]:
+    """
+    Hardlink the files of the current version whose name passes `include` into `out_dir`, copying them if linking
+    fails. Published files are never modified in place, so the versions can share them.
+    """
+    current = current_version(Path(root))
+    if current is None:
+        return []
+    names = []
+    for path in sorted(current.iterdir()):
+        if not path.is_file() or not include(path.name):
+            continue
+        try:
+            os.link(path, out_dir / path.name)
+        except OSError:
+            shutil.copy2(path, out_dir / path.name)
+        names.append(path.name)
+    logger.debug("Carried over from %s: %s", current, names)
+    return names
+
+
+def collect_garbage(root: Path, keep: int):
+    """
+    Remove all but the newest `keep` versions (never the current one), and temporary directories of crashed runs
+    """
+    current = current_version(root)
+    for version in list_versions(root)[:-keep] if keep > 0 else list_versions(root):
+        if current is not None and version.resolve() == current:
+            continue
+        logger.debug("Removing old version: %s", version)
+        shutil.rmtree(version, ignore_errors=True)
+
+    versions_dir = root / VERSIONS_DIR
+    for path in versions_dir.glob(f"{TMP_PREFIX}*{TMP_SUFFIX}"):
+        if time.time() - path.stat().st_mtime > STALE_TMP_SECONDS:
+            logger.debug("Removing stale temporary directory: %s", path)
+            shutil.rmtree(path, ignore_errors=True)
+
+
+@contextmanager
+def publish(root: str | Path, keep: int = 5):
+    """
+    Yield a fresh directory to write outputs into, and publish it as `root/current` once the body completes.
+
+    If the body raises, the partial outputs are discarded and `current` is left untouched.
+    """
+    root = Path(root)
+    versions_dir = root / VERSIONS_DIR
+    versions_dir.mkdir(parents=True, exist_ok=True)
+    name = datetime.now(tz=timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    tmp_dir = versions_dir / f"{TMP_PREFIX}{name}.{os.getpid()}{TMP_SUFFIX}"
+    tmp_dir.mkdir()
+    try:
+        yield tmp_dir
+        _fsync_tree(tmp_dir)
+        version = versions_dir / name
+        os.rename(tmp_dir, version)
+        fsync_dir(versions_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    swap_current(root, version)
+    logger.info("Published: %s", version.as_posix())
+    collect_garbage(root, keep=keep)